@@ -59,6 +59,10 @@ class SimulationFrame(
     limda_default: dict[str, Any]
 
     def __init__(self, para: str = ""):
+        self._frame_version = 0
+        self._nl_cache = None
+        self._nl_cache_key = None
+        self._nl_cache_snapshot = None
         self.atoms = None
         self.cell = None
         self.atom_symbol_to_type = None
@@ -72,6 +76,26 @@ class SimulationFrame(
         self.import_limda_default()
         self.import_para_from_str(para)
 
+    @property
+    def atoms(self) -> pd.DataFrame:
+        return self._atoms
+
+    @atoms.setter
+    def atoms(self, atoms: pd.DataFrame) -> None:
+        # atomsが更新されたらneighbor listのcacheを無効にする
+        self._atoms = atoms
+        self._frame_version += 1
+
+    @property
+    def cell(self) -> np.ndarray[float]:
+        return self._cell
+
+    @cell.setter
+    def cell(self, cell: np.ndarray[float]) -> None:
+        # cellが更新されたらneighbor listのcacheを無効にする
+        self._cell = cell
+        self._frame_version += 1
+
     def __getitem__(self, key) -> pd.DataFrame:
         """
         sdat.atoms[column]をsdat[column]と省略して書くことが出来る。
@@ -80,6 +104,7 @@ class SimulationFrame(
 
     def __setitem__(self, key, val) -> None:
         self.atoms[key] = val
+        self._frame_version += 1
 
     def __len__(self) -> int:
         """
@@ -178,6 +178,8 @@ class SimulationFrames(
                                        device=device,
                                        allegro_model=allegro_model,
                                        flag_calc_virial=flag_calc_virial)
+            # 解析が終わったフレームのneighbor listはcacheしておかない
+            self.sf[frame_idx].clear_neighbor_list_cache()
 
     def concat_force_and_pred_force(self,
                                     reduce_direction: bool = False,
@@ -1,10 +1,245 @@
 import numpy as np
-from collections import deque
-import ase
-from ase.neighborlist import neighbor_list
+import threading
+from functools import lru_cache
 
-from .neighbor import get_neighbor_list_using_cython
-from .analyze_mols import get_mols_list_using_cython
+# Cythonのmoduleはimportに時間がかかるので、初めて使うときにimportしてここに持っておく
+# (get_sum_of_momentumsだけを使う場合などはimportしない)
+_neighbor = None
+_analyze_mols = None
+
+
+def _get_neighbor_module():
+    """Cythonのneighbor moduleを返す, 初めて呼ばれたときにimportする
+    """
+    global _neighbor
+    if _neighbor is None:
+        from . import neighbor
+        _neighbor = neighbor
+    return _neighbor
+
+
+def _get_analyze_mols_module():
+    """Cythonのanalyze_mols moduleを返す, 初めて呼ばれたときにimportする
+    """
+    global _analyze_mols
+    if _analyze_mols is None:
+        from . import analyze_mols
+        _analyze_mols = analyze_mols
+    return _analyze_mols
+
+
+# neighbor list作成用のbufferはスレッドごとに1つ持ち、フレーム間で使い回す
+# (解放するときはrelease_neighbor_workspace()を呼ぶ)
+_neighbor_workspace = threading.local()
+
+
+def _get_neighbor_workspace() -> "NeighborWorkspace":
+    """このスレッドのNeighborWorkspaceを返す, なければ作成する
+    """
+    if not hasattr(_neighbor_workspace, "ws"):
+        _neighbor_workspace.ws = _get_neighbor_module().NeighborWorkspace()
+    return _neighbor_workspace.ws
+
+
+def release_neighbor_workspace() -> None:
+    """このスレッドのneighbor list作成用bufferを解放する
+    bufferは前のフレームよりずっと小さいフレームを解析したときにも自動で解放されるが、
+    大きなフレームを解析した後にすぐメモリを返したいときはこれを呼ぶ
+    """
+    ws = getattr(_neighbor_workspace, "ws", None)
+    if ws is not None:
+        ws.clear()
+
+
+@lru_cache(maxsize=4096)
+def _format_mol_str(atom_type_count: bytes, atom_symbols: tuple[str]) -> str:
+    """原子typeごとの個数から分子の文字列("H2O1"など)を作成する
+    同じ分子は何度も現れるので、結果をcacheする
+    (分子の種類が多い系でもメモリが増え続けないよう、cacheする数には上限をつける)
+    Parameters
+    ----------
+        atom_type_count: bytes
+            原子typeごとの個数(int64のndarray)をtobytes()したもの
+            tupleにするより作成するobjectが少なく、hashも速い
+        atom_symbols: tuple[str]
+            原子typeの順に並べた原子の記号
+    """
+    counts = np.frombuffer(atom_type_count, dtype=np.int64).tolist()
+    mol_str = ""
+    for atom_symbol, count in zip(atom_symbols, counts):
+        if count == 0:
+            continue
+        mol_str += f"{atom_symbol}{count}"
+    return mol_str
+
+
+def _count_atom_types_per_mol(mol_labels: np.ndarray, atom_types: np.ndarray,
+                              atom_type_num: int) -> np.ndarray:
+    """分子ごとに原子typeの個数を数える
+    mol_labelsは原子を含む分子のうち最小の原子idxなので、
+    分子は最小の原子idxの順(get_mols_list()と同じ順)に並ぶ
+    Returns
+    -------
+        atom_type_counts: np.ndarray[int]
+            shape:[分子数, 原子type数]
+    """
+    roots = np.flatnonzero(mol_labels == np.arange(len(mol_labels)))
+    mol_ids = np.searchsorted(roots, mol_labels)
+    atom_type_counts = np.zeros((len(roots), atom_type_num), dtype=np.int64)
+    np.add.at(atom_type_counts, (mol_ids, atom_types - 1), 1)
+    return atom_type_counts
+
+
+def _group_mols_by_species(atom_type_counts: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """原子typeの個数が同じ分子をまとめる
+    分子の種類は、初めて現れた順に並ぶ
+    Returns
+    -------
+        species: np.ndarray[int]
+            shape:[分子の種類数, 原子type数], 分子の種類ごとの原子typeの個数
+        species_ids: np.ndarray[int]
+            shape:[分子数], 分子がspeciesの何番目の種類か
+        species_counts: np.ndarray[int]
+            shape:[分子の種類数], 分子の種類ごとの分子数
+    """
+    mol_num, atom_type_num = atom_type_counts.shape
+    if atom_type_num <= 8 and (mol_num == 0 or atom_type_counts.max() < 256):
+        # 原子typeが8種類以下で、1分子内の各typeの原子数が255以下のときは
+        # 1typeあたり1byteに詰めて1つの整数をkeyにする(行ごとのnp.uniqueより速い)
+        key_bytes = 4 if atom_type_num <= 4 else 8
+        packed = np.zeros((mol_num, key_bytes), dtype=np.uint8)
+        packed[:, :atom_type_num] = atom_type_counts
+        keys = packed.view(np.uint32 if key_bytes == 4 else np.uint64).reshape(-1)
+        _, first_idxes, species_ids, species_counts = np.unique(
+            keys, return_index=True, return_inverse=True, return_counts=True
+        )
+        species = atom_type_counts[first_idxes]
+    else:
+        species, first_idxes, species_ids, species_counts = np.unique(
+            atom_type_counts, axis=0, return_index=True, return_inverse=True, return_counts=True
+        )
+    # np.uniqueはsortされるので、初めて現れた順に並べ直す
+    order = np.argsort(first_idxes)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return species[order], rank[species_ids.reshape(-1)], species_counts[order]
+
+
+def _make_search_params(
+    mode: str, cut_off: float, bond_length: list[list[float]], atom_type_num: int
+) -> tuple[tuple, float, np.ndarray, float]:
+    """modeに応じて、mesh探索に渡すパラメータを求める
+    Returns
+    -------
+        cache_param: tuple
+            cacheのkeyにするパラメータ
+        mesh_length: float
+            meshの一辺の長さ
+        bond_length_sq: np.ndarray[float]
+            結合の長さの2乗, shape:[原子type数, 原子type数], mode = "cut_off"のときはNone
+        cut_off_sq: float
+            カットオフ半径の2乗, mode = "bond_length"のときは0.0
+    """
+    if mode == "bond_length":
+        bond_length_arr = np.asarray(bond_length, dtype=np.float64)
+        assert bond_length_arr.shape == (
+            atom_type_num, atom_type_num), "Incorrect format of bond length"
+        cache_param = (mode, bond_length_arr.tobytes())
+        mesh_length = float(bond_length_arr.max()) + 0.01  # bond_length + margin
+        # 原子対ごとにsqrtや2乗をしないよう、2乗した表を渡す
+        bond_length_sq = np.ascontiguousarray(bond_length_arr ** 2)
+        cut_off_sq = 0.0
+    else:
+        cut_off = float(cut_off)
+        cache_param = (mode, cut_off)
+        mesh_length = cut_off + 0.01  # cut_off + margin
+        bond_length_sq = None
+        cut_off_sq = cut_off * cut_off
+    return cache_param, mesh_length, bond_length_sq, cut_off_sq
+
+
+def _analyze_arrays(
+    atom_types: np.ndarray, pos_x: np.ndarray, pos_y: np.ndarray, pos_z: np.ndarray,
+    cell: np.ndarray, atom_type_num: int, mode: str,
+    mesh_length: float, bond_length_sq: np.ndarray, cut_off_sq: float,
+) -> tuple[np.ndarray[int], np.ndarray[int], np.ndarray[int], np.ndarray[int]]:
+    """原子のtype, 座標のndarray(SoA)から、一度のmesh探索で
+    neighbor list(CSR形式), 結合数, 分子のlabelを求める
+    atom_typesはint32, pos_x, pos_y, pos_zはfloat64の連続したndarray
+    """
+    if mesh_length * 3 > min(cell):
+        mesh_length = min(cell) / 3
+    if len(atom_types) > 0 and (atom_types.min() < 1 or atom_types.max() > atom_type_num):
+        # 範囲外のtypeはCython内で結合数の配列の外を書き換えてしまうので、ここで止める
+        raise ValueError(
+            f"atom types must be in 1..{atom_type_num} (the number of atom types in para), "
+            f"got {atom_types.min()}..{atom_types.max()}")
+    return _get_neighbor_module().analyze_frame_fused_cython(
+        atoms_type=atom_types,
+        atoms_pos=[pos_x, pos_y, pos_z],
+        mesh_length=mesh_length,
+        atom_num=len(atom_types),
+        bond_length_sq=bond_length_sq,
+        cell=cell,
+        atom_type_num=atom_type_num,
+        ws=_get_neighbor_workspace(),
+        # cut_offのときは全原子対で同じしきい値を使う
+        use_uniform_cutoff=(mode == "cut_off"),
+        cut_off_sq=cut_off_sq,
+    )
+
+
+def _count_mols_kernel(mol_labels: np.ndarray, atom_types: np.ndarray,
+                       atom_symbols: tuple[str]) -> dict[str, int]:
+    """分子のlabelから分子数を数える(count_molsの本体)
+    引数のndarrayは読むだけなので、複数のスレッドから同時に呼んでよい
+    """
+    atom_type_counts = _count_atom_types_per_mol(mol_labels, atom_types, len(atom_symbols))
+    species, _, species_counts = _group_mols_by_species(atom_type_counts)
+    mols_count: dict[str, int] = {}
+    for atom_type_count, count in zip(species, species_counts.tolist()):
+        mols_count[_format_mol_str(atom_type_count.tobytes(), atom_symbols)] = count
+    return mols_count
+
+
+def _count_bonds_kernel(bond_counts: np.ndarray, atom_symbols: tuple[str]) -> dict[str, int]:
+    """結合種ごとの結合数を辞書にする(count_bondsの本体)
+    引数のndarrayは読むだけなので、複数のスレッドから同時に呼んでよい
+    """
+    count_bonds_list = bond_counts.tolist()
+    count_bonds_dict = {}
+    for i in range(len(atom_symbols)):
+        for j in range(i, len(atom_symbols)):
+            bond = f"{atom_symbols[i]}-{atom_symbols[j]}"
+            count_bonds_dict[bond] = count_bonds_list[i][j]
+            if i != j:
+                count_bonds_dict[bond] += count_bonds_list[j][i]
+    return count_bonds_dict
+
+
+def _edge_index_kernel(indptr: np.ndarray, indices: np.ndarray) -> list[list[int]]:
+    """CSR形式のneighbor listからedge_index(i < jのみ)を作成する(get_edge_indexの本体)
+    引数のndarrayは読むだけなので、複数のスレッドから同時に呼んでよい
+    """
+    rows = np.repeat(
+        np.arange(len(indptr) - 1, dtype=np.int32), np.diff(indptr)
+    )
+    mask = rows < indices  # i -> j only
+    return [rows[mask].tolist(), indices[mask].tolist()]
+
+
+def _analyze_all_kernels(
+    indptr: np.ndarray, indices: np.ndarray, bond_counts: np.ndarray,
+    mol_labels: np.ndarray, atom_types: np.ndarray, atom_symbols: tuple[str],
+) -> dict[str, object]:
+    """一度のmesh探索の結果からcount_mols, count_bonds, edge_indexを求める(analyze_allの本体)
+    各集計はGILを持ったまま動くので、スレッドには分けずに順に行う
+    """
+    return {
+        "count_mols": _count_mols_kernel(mol_labels, atom_types, atom_symbols),
+        "count_bonds": _count_bonds_kernel(bond_counts, atom_symbols),
+        "edge_index": _edge_index_kernel(indptr, indices),
+    }
 
 
 class AnalyzeFrame:
@@ -15,6 +250,61 @@ class AnalyzeFrame:
         self, mode: str, cut_off: float = None, bond_length: list[list[float]] = None
     ) -> list[list[int]]:
         """neighbor list を作成する
+        同じ条件で作成したneighbor listはcacheされ、原子やcellが変わるまで再利用される
+        Parameters
+        ----------
+            mode: str
+                "bond_length"または"cut_off"
+                mode = "bond_length"とした場合はneighbor listを結合種の長さ(bond_length)によって作成する
+                mode = "cut_off"とした場合はneighbor listをカットオフによって作成する
+            cut_off: float
+                カットオフ半径
+            bond_length: list[list[float]]
+                結合の長さ
+        """
+        indptr, indices, _, _ = self._analyze_frame_cached(
+            mode=mode, cut_off=cut_off, bond_length=bond_length
+        )
+        bounds = indptr.tolist()
+        flat_indices = indices.tolist()
+        return [
+            flat_indices[bounds[atom_idx]:bounds[atom_idx + 1]]
+            for atom_idx in range(len(bounds) - 1)
+        ]
+
+    def get_neighbor_list_csr(
+        self, mode: str, cut_off: float = None, bond_length: list[list[float]] = None
+    ) -> tuple[np.ndarray[int], np.ndarray[int]]:
+        """neighbor list をCSR形式で作成する
+        原子iの隣接原子のidxはindices[indptr[i]:indptr[i+1]]に入る
+        返り値のndarrayはcacheを共有しているので書き換え不可
+        Parameters
+        ----------
+            mode: str
+                "bond_length"または"cut_off"
+                mode = "bond_length"とした場合はneighbor listを結合種の長さ(bond_length)によって作成する
+                mode = "cut_off"とした場合はneighbor listをカットオフによって作成する
+            cut_off: float
+                カットオフ半径
+            bond_length: list[list[float]]
+                結合の長さ
+        Returns
+        -------
+            indptr: np.ndarray[int]
+                shape:[原子数+1], dtype:int64
+            indices: np.ndarray[int]
+                shape:[隣接ペア数*2], dtype:int32
+        """
+        indptr, indices, _, _ = self._analyze_frame_cached(
+            mode=mode, cut_off=cut_off, bond_length=bond_length
+        )
+        return indptr, indices
+
+    def _analyze_frame_cached(
+        self, mode: str, cut_off: float = None, bond_length: list[list[float]] = None
+    ) -> tuple[np.ndarray[int], np.ndarray[int], np.ndarray[int], np.ndarray[int]]:
+        """一度のmesh探索で求めたneighbor list(CSR形式), 結合数, 分子のlabelを返す
+        cacheがあればそれを返し、なければ作成してcacheする
         Parameters
         ----------
             mode: str
@@ -25,42 +315,81 @@ class AnalyzeFrame:
                 カットオフ半径
             bond_length: list[list[float]]
                 結合の長さ
+        Returns
+        -------
+            indptr, indices: np.ndarray[int]
+                CSR形式のneighbor list
+            bond_counts: np.ndarray[int]
+                shape:[原子type数, 原子type数], bond_counts[ti, tj]はtype(ti+1)の原子i,
+                type(tj+1)の原子j (i < j)の結合数
+            mol_labels: np.ndarray[int]
+                shape:[原子数], 原子を含む分子のうち最小の原子idx
         """
         assert mode == "bond_length" or mode == "cut_off", "Please configure mode"
         atom_type_num = len(self.atom_symbol_to_type)
-        if mode == "bond_length":
-            if bond_length is None:
-                if "bond_length" in self.limda_default:
-                    bond_length = self.limda_default["bond_length"]
-            assert len(
-                bond_length) == atom_type_num, "Incorrect format of bond length"
-            for bond_list in bond_length:
-                assert (
-                    len(bond_list) == atom_type_num
-                ), "Incorrect format of bond length"
-        elif mode == "cut_off":
-            if cut_off is None:
-                if "cut_off" in self.limda_default:
-                    cut_off = self.limda_default["cut_off"]
-            bond_length = [
-                [cut_off for _ in range(atom_type_num)] for __ in range(atom_type_num)
-            ]
+        if mode == "bond_length" and bond_length is None:
+            if "bond_length" in self.limda_default:
+                bond_length = self.limda_default["bond_length"]
+        if mode == "cut_off" and cut_off is None:
+            if "cut_off" in self.limda_default:
+                cut_off = self.limda_default["cut_off"]
+        cache_param, mesh_length, bond_length_sq, cut_off_sq = _make_search_params(
+            mode, cut_off, bond_length, atom_type_num)
+
+        # bond_countsの形は原子type数で決まるので、cut_offのときもkeyに含める
+        cache_key = (cache_param, atom_type_num, self._frame_version)
+
+        # sf.atoms, sf.cellがin-placeに書き換えられた場合に備えて中身も比較する
+        # 比較はsf.atomsと直接行い、cacheには作成したときの値を1つだけ持っておく
+        current = (
+            self.atoms["type"].to_numpy(),
+            self.atoms["x"].to_numpy(),
+            self.atoms["y"].to_numpy(),
+            self.atoms["z"].to_numpy(),
+            np.asarray(self.cell),
+        )
+        if (
+            self._nl_cache is not None
+            and self._nl_cache_key == cache_key
+            and all(
+                np.array_equal(cached, now)
+                for cached, now in zip(self._nl_cache_snapshot, current)
+            )
+        ):
+            return self._nl_cache
 
-        mesh_length = (
-            max(list(map(lambda x: max(x), bond_length))) + 0.01
-        )  # cut_off(bond_length) + margin
-        if mesh_length * 3 > min(self.cell):
-            mesh_length = min(self.cell) / 3
-
-        neighbor_list = get_neighbor_list_using_cython(
-            atoms_type=self.atoms["type"],
-            atoms_pos=[self.atoms["x"], self.atoms["y"], self.atoms["z"]],
-            mesh_length=mesh_length,
-            atom_num=len(self),
-            bond_length=bond_length,
-            cell=self.cell,
+        snapshot = self._make_soa_snapshot()
+        atom_types, pos_x, pos_y, pos_z, cell = snapshot
+        analyzed = _analyze_arrays(
+            atom_types, pos_x, pos_y, pos_z,
+            cell, atom_type_num, mode, mesh_length, bond_length_sq, cut_off_sq
+        )
+        for arr in analyzed:
+            arr.flags.writeable = False
+        self._nl_cache = analyzed
+        self._nl_cache_key = cache_key
+        self._nl_cache_snapshot = snapshot
+        return self._nl_cache
+
+    def clear_neighbor_list_cache(self) -> None:
+        """cacheしたneighbor listを削除し、そのメモリを解放する
+        多くのフレームを順に解析するときは、フレームごとに呼ぶとメモリが増え続けない
+        """
+        self._nl_cache = None
+        self._nl_cache_key = None
+        self._nl_cache_snapshot = None
+
+    def _make_soa_snapshot(self) -> tuple[np.ndarray, ...]:
+        """sf.atomsのtype, 座標, cellを連続したndarray(SoA)としてcopyする
+        neighbor listを作成するCythonにはこのndarrayをそのまま渡し、cacheの比較にも使う
+        """
+        return (
+            self.atoms["type"].to_numpy(dtype=np.int32, copy=True),
+            self.atoms["x"].to_numpy(dtype=np.float64, copy=True),
+            self.atoms["y"].to_numpy(dtype=np.float64, copy=True),
+            self.atoms["z"].to_numpy(dtype=np.float64, copy=True),
+            np.array(self.cell, dtype=np.float64),
         )
-        return neighbor_list
 
     def get_mols_list(
         self,
@@ -85,10 +414,11 @@ class AnalyzeFrame:
             bond_length: list[list[float]]
                 結合の長さ
         """
-        neighbor_list = self.get_neighbor_list(
+        indptr, indices, _, _ = self._analyze_frame_cached(
             mode=mode, cut_off=cut_off, bond_length=bond_length
         )
-        return get_mols_list_using_cython(neighbor_list, self.get_total_atoms())
+        return _get_analyze_mols_module().get_mols_list_csr_using_cython(
+            indptr, indices, self.get_total_atoms())
 
     def get_mols_dict(
         self,
@@ -115,29 +445,24 @@ class AnalyzeFrame:
         mols_list = self.get_mols_list(
             mode=mode, cut_off=cut_off, bond_length=bond_length
         )
-        mols_dict_tmp: dict[tuple(int), list[list[int]]] = {}
-        atom_types: np.ndarray[int] = self.atoms["type"].values
-
-        for mol in mols_list:
-            atom_type_count: list[int] = [
-                0 for _ in range(len(self.atom_type_to_symbol))
-            ]
-            for atom_idx in mol:
-                atom_type_count[atom_types[atom_idx] - 1] += 1
-            atom_type_count_tuple = tuple(atom_type_count)
-            if atom_type_count_tuple not in mols_dict_tmp:
-                mols_dict_tmp[atom_type_count_tuple] = []
-            mols_dict_tmp[atom_type_count_tuple].append(mol)
+        _, _, _, mol_labels = self._analyze_frame_cached(
+            mode=mode, cut_off=cut_off, bond_length=bond_length
+        )
+        atom_type_num = len(self.atom_type_to_symbol)
+        atom_type_counts = _count_atom_types_per_mol(
+            mol_labels, self.atoms["type"].to_numpy(dtype=np.int32), atom_type_num)
+        species, species_ids, _ = _group_mols_by_species(atom_type_counts)
 
         mols_dict: dict[str, list[list[int]]] = {}
-        for atom_type_count, mols in mols_dict_tmp.items():
-            mol_str = ""
-            for atom_type in range(len(self.atom_type_to_symbol)):
-                if atom_type_count[atom_type] == 0:
-                    continue
-                mol_str += f"{self.atom_type_to_symbol[atom_type + 1]}{atom_type_count[atom_type]}"
-
-            mols_dict[mol_str] = mols
+        atom_symbols = self._atom_symbols()
+        mol_idxes = np.argsort(species_ids, kind="stable")
+        species_starts = np.searchsorted(species_ids[mol_idxes], np.arange(len(species) + 1))
+        for species_id, atom_type_count in enumerate(species):
+            mol_str = _format_mol_str(atom_type_count.tobytes(), atom_symbols)
+            mols_dict[mol_str] = [
+                mols_list[mol_idx]
+                for mol_idx in mol_idxes[species_starts[species_id]:species_starts[species_id + 1]]
+            ]
 
         return mols_dict
 
@@ -162,34 +487,10 @@ class AnalyzeFrame:
             bond_length: list[list[float]]
                 結合の長さ
         """
-        mols_list = self.get_mols_list(
+        _, _, _, mol_labels = self._analyze_frame_cached(
             mode=mode, cut_off=cut_off, bond_length=bond_length
         )
-        mols_count_tmp: dict[tuple(int), int] = {}
-        atom_types: np.ndarray[int] = self.atoms["type"].values
-
-        for mol in mols_list:
-            atom_type_count: list[int] = [
-                0 for _ in range(len(self.atom_type_to_symbol))
-            ]
-            for atom_idx in mol:
-                atom_type_count[atom_types[atom_idx] - 1] += 1
-            atom_type_count_tuple = tuple(atom_type_count)
-            if atom_type_count_tuple not in mols_count_tmp:
-                mols_count_tmp[atom_type_count_tuple] = 0
-            mols_count_tmp[atom_type_count_tuple] += 1
-
-        mols_count: dict[str, int] = {}
-        for atom_type_count, count in mols_count_tmp.items():
-            mol_str = ""
-            for atom_type in range(len(self.atom_type_to_symbol)):
-                if atom_type_count[atom_type] == 0:
-                    continue
-                mol_str += f"{self.atom_type_to_symbol[atom_type + 1]}{atom_type_count[atom_type]}"
-
-            mols_count[mol_str] = count
-
-        return mols_count
+        return _count_mols_kernel(mol_labels, self.atoms["type"].to_numpy(dtype=np.int32), self._atom_symbols())
 
     def count_bonds(
         self,
@@ -211,28 +512,10 @@ class AnalyzeFrame:
             bond_length: list[list[float]]
                 結合の長さ
         """
-        neighbor_list = self.get_neighbor_list(
+        _, _, bond_counts, _ = self._analyze_frame_cached(
             mode=mode, cut_off=cut_off, bond_length=bond_length
         )
-        atom_types = self.atoms["type"].values
-        count_bonds_list = [
-            [0 for _ in range(len(self.atom_symbol_to_type))]
-            for _ in range(len(self.atom_symbol_to_type))
-        ]
-        for atom_i_idx in range(self.get_total_atoms()):
-            atom_i_type = atom_types[atom_i_idx]
-            for atom_j_idx in neighbor_list[atom_i_idx]:
-                if atom_i_idx < atom_j_idx:
-                    atom_j_type = atom_types[atom_j_idx]
-                    count_bonds_list[atom_i_type - 1][atom_j_type - 1] += 1
-        count_bonds_dict = {}
-        for atom_i_type in range(1, len(self.atom_symbol_to_type) + 1):
-            for atom_j_type in range(atom_i_type, len(self.atom_symbol_to_type) + 1):
-                bond = f"{self.atom_type_to_symbol[atom_i_type]}-{self.atom_type_to_symbol[atom_j_type]}"
-                count_bonds_dict[bond] = count_bonds_list[atom_i_type - 1][atom_j_type - 1]
-                if atom_i_type != atom_j_type:
-                    count_bonds_dict[bond] += count_bonds_list[atom_j_type - 1][atom_i_type - 1]
-        return count_bonds_dict
+        return _count_bonds_kernel(bond_counts, self._atom_symbols())
 
     def get_edge_index(self, cut_off: float) -> list[list[int]]:
         """allegroのedge_indexを作成します。
@@ -243,14 +526,48 @@ class AnalyzeFrame:
         cut_off: float
             edgeとしてみなす最大距離
         """
-        neighbor_list = self.get_neighbor_list(mode="cut_off", cut_off=cut_off)
-        edge_index = [[], []]
-        for atom_idx in range(self.get_total_atoms()):
-            for neighbor_atom_idx in neighbor_list[atom_idx]:
-                if atom_idx < neighbor_atom_idx:
-                    edge_index[0].append(atom_idx)
-                    edge_index[1].append(neighbor_atom_idx)
-        return edge_index
+        indptr, indices, _, _ = self._analyze_frame_cached(mode="cut_off", cut_off=cut_off)
+        return _edge_index_kernel(indptr, indices)
+
+    def analyze_all(
+        self,
+        mode: str = "bond_length",
+        cut_off: float = None,
+        bond_length: list[list[float]] = None,
+    ) -> dict[str, object]:
+        """同じneighbor listからcount_mols, count_bonds, edge_indexをまとめて求める
+        neighbor listは一度だけ作成し、それぞれの集計はそれを使い回す
+        edge_indexは同じneighbor listから作るので、
+        mode = "cut_off"ならばget_edge_index(cut_off)と同じになる
+        Parameters
+        ----------
+            mode: str
+                "bond_length"または"cut_off"
+                mode = "bond_length"とした場合はneighbor listを結合種の長さ(bond_length)によって作成する
+                mode = "cut_off"とした場合はneighbor listをカットオフによって作成する
+            cut_off: float
+                カットオフ半径
+            bond_length: list[list[float]]
+                結合の長さ
+        Returns
+        -------
+            results: dict[str, object]
+                {"count_mols": count_mols()の結果,
+                 "count_bonds": count_bonds()の結果,
+                 "edge_index": edge_index}
+        """
+        indptr, indices, bond_counts, mol_labels = self._analyze_frame_cached(
+            mode=mode, cut_off=cut_off, bond_length=bond_length
+        )
+        return _analyze_all_kernels(
+            indptr, indices, bond_counts, mol_labels,
+            self.atoms["type"].to_numpy(dtype=np.int32), self._atom_symbols())
+
+    def _atom_symbols(self) -> tuple[str]:
+        """原子typeの順に並べた原子の記号を返す
+        """
+        return tuple(self.atom_type_to_symbol[atom_type]
+                     for atom_type in range(1, len(self.atom_type_to_symbol) + 1))
 
     def get_edge_index_for_triclinic_cell(self, cut_off: float) -> list[list[int]]:
         """allegroのedge_indexを作成します。
@@ -261,6 +578,9 @@ class AnalyzeFrame:
         cut_off: float
             edgeとしてみなす最大距離
         """
+        import ase
+        from ase.neighborlist import neighbor_list
+
         ase_atoms = ase.Atoms(positions=self.atoms[['x', 'y', 'z']].values, cell=self.cell, pbc=[1, 1, 1])
 
         i_idx, j_idx, shift = neighbor_list(
@@ -281,11 +601,18 @@ class AnalyzeFrame:
             momentum_sum : np.ndarray[float]
                 運動量の合計 [x, y, z]
         """
-        mass = np.array([self.atom_type_to_mass[typ]
-                        for typ in self.atoms["type"]])
-        momentums = np.array(
-            [self.atoms["vx"], self.atoms["vy"], self.atoms["vz"]]) * mass
-        return np.sum(momentums, axis=1)
+        atom_types = self.atoms["type"].to_numpy(dtype=np.int64)
+        # 質量が登録されていないtypeがあれば、質量0にせずKeyErrorにする
+        missing_types = np.setdiff1d(atom_types, list(self.atom_type_to_mass.keys()))
+        if len(missing_types) > 0:
+            raise KeyError(missing_types[0].item())
+        # mass_table[type]でtypeの質量が得られるようにする
+        mass_table = np.zeros(max(self.atom_type_to_mass, default=0) + 1, dtype=np.float64)
+        mass_table[list(self.atom_type_to_mass.keys())] = list(
+            self.atom_type_to_mass.values())
+        mass = mass_table[atom_types]
+        velocities = self.atoms[["vx", "vy", "vz"]].to_numpy(dtype=np.float64)
+        return (velocities * mass[:, None]).sum(axis=0)
 
     def get_neighbor_list_brute(self, bond_length: list[list[float]]) -> list[list[int]]:
         """ neighbor_listを作成します。
@@ -1,4 +1,45 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
 import pandas as pd
+from .analyze_frame import (
+    _analyze_arrays,
+    _make_search_params,
+    _analyze_all_kernels,
+)
+
+# batch_analyzeのworkerプロセスが共有メモリから作ったndarrayと解析の条件
+_batch_worker_state = {}
+
+
+def _init_batch_worker(shm_specs: dict[str, tuple[str, tuple, str]], search: tuple) -> None:
+    """batch_analyzeのworkerプロセスの初期化
+    親プロセスが作成した共有メモリにattachし、copyせずにndarrayとして参照する
+    """
+    for key, (name, shape, dtype) in shm_specs.items():
+        # workerは親プロセスのresource_trackerを共有するので、unlinkは親プロセスだけで行う
+        shm = shared_memory.SharedMemory(name=name)
+        _batch_worker_state[key + "_shm"] = shm
+        _batch_worker_state[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _batch_worker_state["search"] = search
+
+
+def _batch_analyze_frame(frame_idx: int) -> dict[str, object]:
+    """batch_analyzeのworkerで1フレームを解析する
+    """
+    offsets = _batch_worker_state["offsets"]
+    start, end = offsets[frame_idx], offsets[frame_idx + 1]
+    atom_types = _batch_worker_state["types"][start:end]
+    pos = _batch_worker_state["pos"]
+    mode, atom_symbols, mesh_length, bond_length_sq, cut_off_sq = _batch_worker_state["search"]
+    indptr, indices, bond_counts, mol_labels = _analyze_arrays(
+        atom_types, pos[0, start:end], pos[1, start:end], pos[2, start:end],
+        _batch_worker_state["cells"][frame_idx], len(atom_symbols), mode,
+        mesh_length, bond_length_sq, cut_off_sq,
+    )
+    return _analyze_all_kernels(
+        indptr, indices, bond_counts, mol_labels, atom_types, atom_symbols)
 
 
 class AnalyzeFrames:
@@ -43,6 +84,8 @@ class AnalyzeFrames:
                     mode=mode, cut_off=cut_off, bond_length=bond_length
                 )
             )
+            # 解析が終わったフレームのneighbor listはcacheしておかない
+            self.sf[frame_idx].clear_neighbor_list_cache()
         df_count_mols = pd.DataFrame(count_mols_lists).fillna(0).astype(int)
         df_count_mols.index = self.get_step_nums()
         columns = list(df_count_mols.columns)
@@ -100,6 +143,101 @@ class AnalyzeFrames:
                     mode=mode, cut_off=cut_off, bond_length=bond_length
                 )
             )
+            # 解析が終わったフレームのneighbor listはcacheしておかない
+            self.sf[frame_idx].clear_neighbor_list_cache()
         df_count_bonds = pd.DataFrame(count_bonds_lists).fillna(0).astype(int)
         df_count_bonds.index = self.get_step_nums()
         return df_count_bonds
+
+    def batch_analyze(
+        self,
+        mode: str = "bond_length",
+        cut_off: float = None,
+        bond_length: list[list[float]] = None,
+        max_workers: int = None,
+        chunksize: int = None,
+    ) -> list[dict[str, object]]:
+        """全てのフレームについてsf.analyze_all()と同じ解析を複数のプロセスで行う
+        原子のtype, 座標, cellは共有メモリに置き、workerプロセスはcopyせずに参照する
+        Parameters
+        ----------
+            mode: str
+                "bond_length"または"cut_off"
+                mode = "bond_length"とした場合はneighbor listを結合種の長さ(bond_length)によって作成する
+                mode = "cut_off"とした場合はneighbor listをカットオフによって作成する
+            cut_off: float
+                カットオフ半径
+            bond_length: list[list[float]]
+                結合の長さ
+            max_workers: int
+                workerプロセス数, Noneならばcpu数
+            chunksize: int
+                workerに一度に渡すフレーム数, Noneならばフレーム数/(4*プロセス数)
+        Returns
+        -------
+            results: list[dict[str, object]]
+                フレームごとの{"count_mols": ..., "count_bonds": ..., "edge_index": ...}
+        """
+        assert mode == "bond_length" or mode == "cut_off", "Please configure mode"
+        if mode == "bond_length" and bond_length is None:
+            if "bond_length" in self.limda_default:
+                bond_length = self.limda_default["bond_length"]
+        if mode == "cut_off" and cut_off is None:
+            if "cut_off" in self.limda_default:
+                cut_off = self.limda_default["cut_off"]
+        atom_symbols = tuple(self.atom_type_to_symbol[atom_type]
+                             for atom_type in range(1, len(self.atom_type_to_symbol) + 1))
+        _, mesh_length, bond_length_sq, cut_off_sq = _make_search_params(
+            mode, cut_off, bond_length, len(atom_symbols))
+        if len(self.sf) == 0:
+            return []
+
+        offsets = np.zeros(len(self.sf) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(frame) for frame in self.sf])
+        atom_num = int(offsets[-1])
+        # 共有メモリの形はoffsetsから決まるので、先に確保してからフレームごとに書き込む
+        # (全フレームを結合した配列を一度作ってからcopyすることはしない)
+        shm_layouts = {
+            "offsets": (offsets.shape, np.int64),
+            "types": ((atom_num,), np.int32),
+            # x, y, zをそれぞれ連続させる(SoA)
+            "pos": ((3, atom_num), np.float64),
+            "cells": ((len(self.sf), 3), np.float64),
+        }
+        shms = []
+        shm_arrays = {}
+        try:
+            shm_specs = {}
+            for key, (shape, dtype) in shm_layouts.items():
+                nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+                shms.append(shm)
+                shm_arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                shm_specs[key] = (shm.name, shape, np.dtype(dtype).str)
+            shm_arrays["offsets"][...] = offsets
+            for frame_idx, frame in enumerate(self.sf):
+                start, end = offsets[frame_idx], offsets[frame_idx + 1]
+                # dtypeの変換は共有メモリに書き込むときに行う
+                shm_arrays["types"][start:end] = frame.atoms["type"].to_numpy()
+                for axis, col in enumerate(["x", "y", "z"]):
+                    shm_arrays["pos"][axis, start:end] = frame.atoms[col].to_numpy()
+                shm_arrays["cells"][frame_idx] = frame.cell
+
+            if max_workers is None:
+                max_workers = os.cpu_count() or 1
+            if chunksize is None:
+                chunksize = max(1, len(self.sf) // (4 * max_workers))
+            search = (mode, atom_symbols, mesh_length, bond_length_sq, cut_off_sq)
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_batch_worker,
+                initargs=(shm_specs, search),
+            ) as executor:
+                return list(executor.map(
+                    _batch_analyze_frame, range(len(self.sf)), chunksize=chunksize))
+        finally:
+            # 共有メモリを閉じる前に、それを参照するndarrayをなくしておく
+            shm_arrays.clear()
+            for shm in shms:
+                shm.close()
+                shm.unlink()
@@ -7,11 +7,13 @@ from libcpp.vector cimport vector
 from libcpp.queue cimport queue
 from libcpp cimport bool
 
-cdef vector[vector[int]] get_mols_list(vector[vector[int]] neighbor_list, int atom_num):
+cdef vector[vector[int]] get_mols_list_csr(const long long[::1] indptr, const int[::1] indices, int atom_num):
+    # CSR形式(indptr, indices)のneighbor listから分子ごとの原子のidを求めます。
     cdef:
         vector[bool] visited
         queue[int] que
-        int start_atom_idx
+        int start_atom_idx, now, nex
+        long long k
         vector[vector[int]] mols_list
         int mol_num
 
@@ -31,12 +33,22 @@ cdef vector[vector[int]] get_mols_list(vector[vector[int]] neighbor_list, int at
                 continue
             visited[now] = True
             mols_list[mol_num - 1].push_back(now)
-            for nex in neighbor_list[now]:
+            for k in range(indptr[now], indptr[now + 1]):
+                nex = indices[k]
                 if visited[nex]:
                     continue
                 que.push(nex)
     return mols_list
 
 
-def get_mols_list_using_cython(vector[vector[int]] neighbor_list, int atom_num):
-    return get_mols_list(neighbor_list, atom_num)
+def get_mols_list_using_cython(neighbor_list, int atom_num):
+    # list[list[int]]のneighbor listをCSR形式にして、get_mols_list_csrで分子を求めます。
+    indptr = np.zeros(atom_num + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(neighbor_list[i]) for i in range(atom_num)])
+    indices = np.fromiter(
+        (j for i in range(atom_num) for j in neighbor_list[i]), dtype=np.int32, count=indptr[atom_num])
+    return get_mols_list_csr(indptr, indices, atom_num)
+
+
+def get_mols_list_csr_using_cython(const long long[::1] indptr, const int[::1] indices, int atom_num):
+    return get_mols_list_csr(indptr, indices, atom_num)
@@ -118,6 +118,8 @@ class ExportFrames(
 
             edge_index = [[], []]
             edge_index = self.sf[sf_idx].get_edge_index(cut_off=cut_off)
+            # 解析が終わったフレームのneighbor listはcacheしておかない
+            self.sf[sf_idx].clear_neighbor_list_cache()
 
             data["edge_index"] = np.array(edge_index)
             if test_size is not None:
@@ -124,6 +124,8 @@ class ImportFrame(
         self.atom_type_to_mass = {}
         for atom_symbol, atom_type in self.atom_symbol_to_type.items():
             self.atom_type_to_mass[atom_type] = C.ATOM_SYMBOL_TO_MASS[atom_symbol]
+        # 原子typeの数が変わるとneighbor listのcacheの結合数の形が合わなくなるので無効にする
+        self._frame_version += 1
 
     def import_para_from_str(self, atom_symbol_str: str):
         """
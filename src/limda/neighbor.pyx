@@ -2,7 +2,6 @@
 
 import numpy as np
 import queue
-from libc.stdlib cimport malloc
 from libcpp.vector cimport vector
 from libcpp.queue cimport queue
 from libcpp cimport bool
@@ -14,15 +13,61 @@ cdef struct atom:
     int mesh_id
     double pos[3]
 
-cdef void make_catoms(vector[int] atoms_type, vector[vector[double]] atoms_pos, int atom_num, atom *catoms):
+cdef class NeighborWorkspace:
+    # neighbor listの作成に使うbufferを保持し、フレーム間で使い回します。
+    # vectorはresize, clearしても確保した容量は減らないので、
+    # 同じ程度の原子数, mesh数であれば2回目以降はメモリの再確保が起きません。
+    cdef vector[atom] catoms
+    cdef vector[int] mesh_start  # mesh mの原子はmesh_atoms[mesh_start[m]:mesh_start[m+1]]
+    cdef vector[int] mesh_atoms  # meshの順に並べた原子のid
+    cdef vector[vector[int]] neighbor_list
+
+    cdef void release(self):
+        # 確保したbufferを解放します。空のvectorとswapし、元のbufferは関数を抜けるときに解放されます。
+        cdef:
+            vector[atom] catoms
+            vector[int] mesh_start
+            vector[int] mesh_atoms
+            vector[vector[int]] neighbor_list
+        self.catoms.swap(catoms)
+        self.mesh_start.swap(mesh_start)
+        self.mesh_atoms.swap(mesh_atoms)
+        self.neighbor_list.swap(neighbor_list)
+
+    def clear(self):
+        # 確保したbufferを解放します。次に使うときに必要な大きさで確保し直します。
+        self.release()
+
+    cdef void reserve(self, int atom_num, int mesh_num):
+        # 今回のフレームの大きさに合わせてbufferを用意します。
+        # 前のフレームよりずっと小さい(容量の1/4未満)ときは、
+        # 大きなフレームの分のbufferを持ち続けないよう一度解放します。
+        cdef size_t i
+        if (self.catoms.capacity() > 4 * <size_t>atom_num + 4096
+                or self.mesh_start.capacity() > 4 * <size_t>mesh_num + 4096):
+            self.release()
+        self.catoms.resize(atom_num)
+        self.mesh_start.resize(mesh_num + 1)
+        self.mesh_atoms.resize(atom_num)
+        for i in range(self.neighbor_list.size()):
+            self.neighbor_list[i].clear()
+        self.neighbor_list.resize(atom_num)
+
+cdef void make_catoms(const int[::1] atoms_type,
+                      const double[::1] pos_x,
+                      const double[::1] pos_y,
+                      const double[::1] pos_z,
+                      int atom_num,
+                      atom *catoms) except *:
     # sfから持ってきた、原子のtype,positionをatom構造体として記録します。
+    # type, 座標は連続したndarray(SoA)で受け取ります。
     cdef int i
     for i in range(atom_num):
         catoms[i].typ = atoms_type[i]
         catoms[i].id = i
-        catoms[i].pos[0] = atoms_pos[0][i]
-        catoms[i].pos[1] = atoms_pos[1][i]
-        catoms[i].pos[2] = atoms_pos[2][i]
+        catoms[i].pos[0] = pos_x[i]
+        catoms[i].pos[1] = pos_y[i]
+        catoms[i].pos[2] = pos_z[i]
 
 cdef void make_mesh_size(vector[double] cell, double mesh_length, int mesh_size[3], double mesh_length_adjusted[3]):
     # x,y,zのmeshの個数を決めます。
@@ -49,27 +94,63 @@ cdef void make_mesh_id(int mesh_size[3], atom *catoms, double mesh_length_adjust
 
         catoms[i].mesh_id = mesh_num[2]*mesh_size[0]*mesh_size[1] + mesh_num[1]*mesh_size[0] + mesh_num[0]
 
-cdef vector[vector[int]] get_append_mesh(atom *catoms, vector[vector[int]] append_mesh, int atom_num):
-    # meshそれぞれにどの原子がいるかをappend_meshに記録します.
-    cdef int i
+cdef void make_mesh_atoms(atom *catoms, int atom_num, int mesh_num,
+                          vector[int] &mesh_start, vector[int] &mesh_atoms):
+    # meshそれぞれにどの原子がいるかをmesh_start, mesh_atomsに記録します.
+    # 原子をmesh_idで数え上げソートし、各mesh内では原子のidの昇順に並べます.
+    cdef int i, m
+    for m in range(mesh_num + 1):
+        mesh_start[m] = 0
     for i in range(atom_num):
-        append_mesh[catoms[i].mesh_id].push_back(catoms[i].id)
+        mesh_start[catoms[i].mesh_id] += 1
+    for m in range(1, mesh_num):
+        mesh_start[m] += mesh_start[m - 1]
+    # ここでmesh_start[m]はmesh mの終わり. 後ろから詰めるとmesh mの始まりになる.
+    for i in range(atom_num - 1, -1, -1):
+        mesh_start[catoms[i].mesh_id] -= 1
+        mesh_atoms[mesh_start[catoms[i].mesh_id]] = catoms[i].id
+    mesh_start[mesh_num] = atom_num
 
-    return append_mesh
+cdef int find_root(int *parent, int i):
+    # union-findの根を探します。経路を半分に縮めながら辿ります。
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
 
-cdef vector[vector[int]] search_neighbors(atom *catoms,
-                                          vector[vector[int]] append_mesh,
-                                          int mesh_size[3],
-                                          vector[vector[int]] neighbor_list,
-                                          vector[vector[double]] bond_length,
-                                          vector[double] cell):
+cdef void union_atoms(int *parent, int i, int j):
+    # 原子i, jを同じ分子にします。idxが小さい方を根にします。
+    cdef int ri = find_root(parent, i)
+    cdef int rj = find_root(parent, j)
+    if ri < rj:
+        parent[rj] = ri
+    elif rj < ri:
+        parent[ri] = rj
+
+cdef void search_neighbors(atom *catoms,
+                           vector[int] &mesh_start,
+                           vector[int] &mesh_atoms,
+                           int mesh_size[3],
+                           vector[vector[int]] &neighbor_list,
+                           const double[:, ::1] bond_length_sq,
+                           vector[double] &cell,
+                           bool use_uniform_cutoff,
+                           double cut_off_sq,
+                           int atom_type_num,
+                           long long *bond_counts,
+                           int *parent) except *:
     # 近接meshを探索して、原子の結合listを作成します。
-    # bond_lengthを使用します.
+    # use_uniform_cutoffがTrueならば全ての原子対でcut_off_sq(カットオフの2乗)を、
+    # Falseならばbond_length_sq(結合の長さの2乗)を使用します.
+    # bond_counts, parentがNULLでなければ、結合を見つけたときに
+    # 結合種ごとの結合数とunion-findの更新も同時に行います。
     cdef:
         double dx[3]
-        int own_mesh_len, serche_mesh_len
+        int own_mesh_len, search_mesh_len
         atom own, search
         int own_mesh_id, search_mesh_id, iid, jid, dim
+        double dist_sq
+        bool is_bonded
 
     add_idxes = (
         [0,0,0],
@@ -88,54 +169,159 @@ cdef vector[vector[int]] search_neighbors(atom *catoms,
         [1,1,1],
     )
     for own_mesh_id in range(mesh_size[0]*mesh_size[1]*mesh_size[2]):
-        own_mesh_len = len(append_mesh[own_mesh_id])
+        own_mesh_len = mesh_start[own_mesh_id + 1] - mesh_start[own_mesh_id]
         for add_idx in add_idxes:
             search_mesh_id = (own_mesh_id%mesh_size[0] + add_idx[0])%mesh_size[0] \
                 + mesh_size[0]*((own_mesh_id/mesh_size[0] + add_idx[1])%mesh_size[1]) \
                 + mesh_size[0]*mesh_size[1]*((own_mesh_id/(mesh_size[0]*mesh_size[1]) + add_idx[2])%mesh_size[2])
-            search_mesh_len = len(append_mesh[search_mesh_id])
+            search_mesh_len = mesh_start[search_mesh_id + 1] - mesh_start[search_mesh_id]
             for iid in range(own_mesh_len):
-                own = catoms[append_mesh[own_mesh_id][iid]]
+                own = catoms[mesh_atoms[mesh_start[own_mesh_id] + iid]]
                 start = (search_mesh_id == own_mesh_id)
                 for jid in range(start*(iid+1), search_mesh_len):
-                    search = catoms[append_mesh[search_mesh_id][jid]]
+                    search = catoms[mesh_atoms[mesh_start[search_mesh_id] + jid]]
                     for dim in range(3):
                         dx[dim] = search.pos[dim] - own.pos[dim]
                         if dx[dim] < -cell[dim]/2:
                             dx[dim] += cell[dim]
                         if cell[dim]/2 < dx[dim]:
                             dx[dim] -= cell[dim]
-                    if dx[0]*dx[0]+dx[1]*dx[1]+dx[2]*dx[2] <= bond_length[own.typ-1][search.typ-1]*bond_length[own.typ-1][search.typ-1]:
+                    dist_sq = dx[0]*dx[0]+dx[1]*dx[1]+dx[2]*dx[2]
+                    if use_uniform_cutoff:
+                        is_bonded = dist_sq <= cut_off_sq
+                    else:
+                        is_bonded = dist_sq <= bond_length_sq[own.typ-1, search.typ-1]
+                    if is_bonded:
                         neighbor_list[own.id].push_back(search.id)
                         neighbor_list[search.id].push_back(own.id)
-    return neighbor_list
-
-cdef vector[vector[int]] make_neighbor_list(vector[int] atoms_type,
-                                            vector[vector[double]] atoms_pos,
-                                            double mesh_length,
-                                            int atom_num,
-                                            vector[vector[double]] bond_length,
-                                            vector[double] cell):
+                        if bond_counts != NULL:
+                            if own.id < search.id:
+                                bond_counts[(own.typ-1)*atom_type_num + search.typ-1] += 1
+                            else:
+                                bond_counts[(search.typ-1)*atom_type_num + own.typ-1] += 1
+                        if parent != NULL:
+                            union_atoms(parent, own.id, search.id)
+
+cdef void make_neighbor_list(const int[::1] atoms_type,
+                             const double[::1] pos_x,
+                             const double[::1] pos_y,
+                             const double[::1] pos_z,
+                             double mesh_length,
+                             int atom_num,
+                             const double[:, ::1] bond_length_sq,
+                             vector[double] &cell,
+                             NeighborWorkspace ws,
+                             bool use_uniform_cutoff,
+                             double cut_off_sq,
+                             int atom_type_num = 0,
+                             long long *bond_counts = NULL,
+                             int *parent = NULL) except *:
+    # ws.neighbor_listにneighbor listを作成します。
     cdef:
-        atom *catoms = <atom *> malloc(atom_num * sizeof(atom))
         int mesh_size[3]
         double mesh_length_adjusted[3]
-        vector[vector[int]] append_mesh
-        vector[vector[int]] neighbor_list
+        int mesh_num
 
-    make_catoms(atoms_type, atoms_pos, atom_num, catoms)
     make_mesh_size(cell, mesh_length, mesh_size, mesh_length_adjusted)
-    make_mesh_id(mesh_size, catoms, mesh_length_adjusted, atom_num)
-    append_mesh.resize(mesh_size[0]*mesh_size[1]*mesh_size[2])
-    append_mesh = get_append_mesh(catoms, append_mesh, atom_num)
-    neighbor_list.resize(atom_num)
-    neighbor_list = search_neighbors(catoms, append_mesh, mesh_size, neighbor_list, bond_length, cell)
-    return neighbor_list
-
-def get_neighbor_list_using_cython(vector[int] atoms_type,
-                                   vector[vector[double]] atoms_pos,
+    mesh_num = mesh_size[0]*mesh_size[1]*mesh_size[2]
+    ws.reserve(atom_num, mesh_num)
+    if atom_num == 0:
+        return
+    make_catoms(atoms_type, pos_x, pos_y, pos_z, atom_num, &ws.catoms[0])
+    make_mesh_id(mesh_size, &ws.catoms[0], mesh_length_adjusted, atom_num)
+    make_mesh_atoms(&ws.catoms[0], atom_num, mesh_num, ws.mesh_start, ws.mesh_atoms)
+    search_neighbors(&ws.catoms[0], ws.mesh_start, ws.mesh_atoms, mesh_size, ws.neighbor_list,
+                     bond_length_sq, cell, use_uniform_cutoff, cut_off_sq, atom_type_num, bond_counts, parent)
+
+cdef tuple make_neighbor_list_csr(vector[vector[int]] &neighbor_list, int atom_num):
+    # vector[vector[int]]のneighbor listをCSR形式(indptr, indices)にします。
+    # 原子iの隣接原子はindices[indptr[i]:indptr[i+1]]に入ります。
+    cdef:
+        long long[::1] indptr
+        int[::1] indices
+        int i, k
+        long long pos
+
+    indptr_arr = np.zeros(atom_num + 1, dtype=np.int64)
+    indptr = indptr_arr
+    for i in range(atom_num):
+        indptr[i + 1] = indptr[i] + neighbor_list[i].size()
+    indices_arr = np.empty(indptr[atom_num], dtype=np.int32)
+    indices = indices_arr
+    for i in range(atom_num):
+        pos = indptr[i]
+        for k in range(neighbor_list[i].size()):
+            indices[pos + k] = neighbor_list[i][k]
+    return indptr_arr, indices_arr
+
+def analyze_frame_fused_cython(const int[::1] atoms_type,
+                               atoms_pos,
+                               double mesh_length,
+                               int atom_num,
+                               const double[:, ::1] bond_length_sq,
+                               vector[double] cell,
+                               int atom_type_num,
+                               NeighborWorkspace ws = None,
+                               bool use_uniform_cutoff = False,
+                               double cut_off_sq = 0.0):
+    # 一度のmesh探索で、CSR形式のneighbor list, 結合種ごとの結合数, 分子のlabelを求めます。
+    # bond_counts[ti, tj]: type(ti+1)の原子i, type(tj+1)の原子j (i < j)の結合数
+    # parent[i]: 原子iを含む分子のうち最小の原子idx
+    # wsを渡すとbufferを使い回します。
+    # bond_length_sq: 結合の長さの2乗, float64のndarray, shape:[原子type数, 原子type数]
+    # use_uniform_cutoff = Trueならばbond_length_sqは使わず(Noneでよい)、cut_off_sq(カットオフの2乗)で判定します。
+    cdef:
+        const double[::1] pos_x = atoms_pos[0]
+        const double[::1] pos_y = atoms_pos[1]
+        const double[::1] pos_z = atoms_pos[2]
+        long long[:, ::1] bond_counts
+        int[::1] parent
+        int i
+
+    if ws is None:
+        ws = NeighborWorkspace()
+    bond_counts_arr = np.zeros((atom_type_num, atom_type_num), dtype=np.int64)
+    parent_arr = np.arange(atom_num, dtype=np.int32)
+    bond_counts = bond_counts_arr
+    parent = parent_arr
+    if atom_num == 0:
+        ws.reserve(0, 0)
+        indptr_arr, indices_arr = make_neighbor_list_csr(ws.neighbor_list, atom_num)
+        return indptr_arr, indices_arr, bond_counts_arr, parent_arr
+
+    make_neighbor_list(atoms_type,pos_x,pos_y,pos_z,mesh_length,atom_num,bond_length_sq,cell,ws,
+                       use_uniform_cutoff,cut_off_sq,atom_type_num,&bond_counts[0, 0],&parent[0])
+    for i in range(atom_num):
+        parent[i] = find_root(&parent[0], i)
+    indptr_arr, indices_arr = make_neighbor_list_csr(ws.neighbor_list, atom_num)
+    return indptr_arr, indices_arr, bond_counts_arr, parent_arr
+
+def get_neighbor_list_csr_using_cython(atoms_type,
+                                       atoms_pos,
+                                       double mesh_length,
+                                       int atom_num,
+                                       bond_length,
+                                       cell):
+    # analyze_frame_fused_cythonで作成したneighbor listだけを
+    # CSR形式(indptr: int64[atom_num+1], indices: int32[num_edges])で返します。
+    # atoms_type, atoms_posはndarrayやpandasのSeriesでよく、ここで連続したndarrayにします。
+    bond_length_arr = np.asarray(bond_length, dtype=np.float64)
+    bond_length_sq = np.ascontiguousarray(bond_length_arr**2)
+    indptr, indices, _, _ = analyze_frame_fused_cython(
+        np.ascontiguousarray(atoms_type, dtype=np.int32),
+        [np.ascontiguousarray(pos, dtype=np.float64) for pos in atoms_pos],
+        mesh_length, atom_num, bond_length_sq, cell, len(bond_length_arr))
+    return indptr, indices
+
+def get_neighbor_list_using_cython(atoms_type,
+                                   atoms_pos,
                                    double mesh_length,
                                    int atom_num,
-                                   vector[vector[double]] bond_length,
-                                   vector[double] cell):
-    return make_neighbor_list(atoms_type,atoms_pos,mesh_length,atom_num,bond_length,cell)
+                                   bond_length,
+                                   cell):
+    # get_neighbor_list_csr_using_cythonと同じneighbor listをlist[list[int]]で返します。
+    indptr, indices = get_neighbor_list_csr_using_cython(
+        atoms_type, atoms_pos, mesh_length, atom_num, bond_length, cell)
+    bounds = indptr.tolist()
+    flat_indices = indices.tolist()
+    return [flat_indices[bounds[i]:bounds[i + 1]] for i in range(atom_num)]